@@ -1,9 +1,28 @@
+import os
+
+# Size the OpenMP/MKL thread pools to the host before torch is imported
+NUM_THREADS = os.cpu_count() or 4
+os.environ.setdefault("OMP_NUM_THREADS", str(NUM_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(NUM_THREADS))
+
 import streamlit as st
-from transformers import pipeline
-import PyPDF2
+import torch
+import pandas as pd
+from transformers import pipeline, AutoTokenizer
+from transformers.utils.logging import disable_progress_bar
+import pymupdf
 from docx import Document
 import google.generativeai as genai
-import os
+from google import genai as genai_batch
+from google.genai import errors as genai_errors
+import httpx
+import io
+import re
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,12 +34,284 @@ if api_key is None:
 
 genai.configure(api_key=api_key)
 
+GEMINI_MODEL_NAME = "gemini-2.0-flash"
+
+# Streamlit reruns this script on every interaction, so the Gemini clients are built once per process
+@st.cache_resource
+def load_gemini_model(model_name):
+    return genai.GenerativeModel(model_name)
+
+@st.cache_resource
+def load_batch_client(api_key):
+    return genai_batch.Client(api_key=api_key)
+
+GEMINI_MODEL = load_gemini_model(GEMINI_MODEL_NAME)
+batch_client = load_batch_client(api_key)
+
+# Fixed prompt text, built once; the disease names are appended per request
+BULK_PROMPT_PREFIX = (
+    "For each disease below, list only the drug names used to treat it. "
+    "Return a JSON object mapping each disease name exactly as written to a list of drug names. "
+    "No explanations, just drug names.\nDiseases:\n"
+)
+SINGLE_PROMPT_TEMPLATE = "List only the drug names used to treat {}, separated by commas. No explanations, just drug names."
+
+# Batch jobs are checked by a background thread every BATCH_POLL_INTERVAL_SECONDS and
+# cancelled if still pending after BATCH_TIMEOUT_SECONDS
+BATCH_TIMEOUT_SECONDS = 3600
+BATCH_POLL_INTERVAL_SECONDS = 30
+BATCH_PENDING = "Pending (Gemini batch job still running)"
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# Drug recommendations are reused across reruns and sessions for this many seconds
+RECOMMENDATION_TTL_SECONDS = 14400
+# Diseases Gemini had no answer for (often NER false positives) are not re-asked for this long
+NO_RECOMMENDATIONS_TTL_SECONDS = 900
+RECOMMENDATION_CACHE_MAX_ENTRIES = 1024
+NO_RECOMMENDATIONS = "No recommendations found"
+
+# BF16 weights halve memory traffic, but are emulated (and slower than FP32) on hardware without native support
+NER_TORCH_DTYPES = {
+    "bfloat16": torch.bfloat16,
+    "bf16": torch.bfloat16,
+    "float16": torch.float16,
+    "fp16": torch.float16,
+    "float32": torch.float32,
+    "fp32": torch.float32,
+}
+
+# Function to pick BF16 only when the GPU or CPU runs it natively
+def default_ner_dtype():
+    if torch.cuda.is_available():
+        return "bfloat16" if torch.cuda.is_bf16_supported() else "float32"
+    # oneDNN's BF16 check also passes on AVX-512 CPUs that only emulate BF16, so look for the real instructions
+    try:
+        cpu_bf16 = torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+    except (AttributeError, RuntimeError):
+        cpu_bf16 = False
+    return "bfloat16" if cpu_bf16 else "float32"
+
+ner_dtype_name = os.getenv("NER_TORCH_DTYPE", default_ner_dtype()).strip().lower()
+if ner_dtype_name not in NER_TORCH_DTYPES:
+    raise ValueError(f"Unsupported NER_TORCH_DTYPE {ner_dtype_name!r}; expected one of {', '.join(NER_TORCH_DTYPES)}")
+NER_TORCH_DTYPE = NER_TORCH_DTYPES[ner_dtype_name]
+torch.set_num_threads(NUM_THREADS)
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    # Already fixed by an earlier Streamlit rerun in this process
+    pass
+
+# Progress bars are re-rendered into the Streamlit log on every batch
+disable_progress_bar()
+
+# INT8-quantized ONNX export of the NER model, used instead of PyTorch when present (see README)
+NER_ONNX_MODEL_DIR = os.getenv("NER_ONNX_MODEL_DIR", "onnx-int8")
+
+# Compile the PyTorch model into fused kernels at load time; set NER_TORCH_COMPILE=0 to disable
+NER_TORCH_COMPILE = os.getenv("NER_TORCH_COMPILE", "1") == "1"
+NER_WARMUP_TEXT = "Patient presents with hypertension."
+
+NER_BATCH_SIZE = 16
+# Inputs longer than MAX_SEQ_LENGTH tokens are split into windows overlapping by TOKEN_STRIDE tokens
+MAX_SEQ_LENGTH = 512
+TOKEN_STRIDE = 32
+
 # Load the BioBERT NER model
 @st.cache_resource
 def load_ner_pipeline():
-    return pipeline("ner", model="d4data/biomedical-ner-all", aggregation_strategy="first")
+    if os.path.isdir(NER_ONNX_MODEL_DIR):
+        # Imported here so deployments without an ONNX export do not need optimum[onnxruntime]
+        from optimum.onnxruntime import ORTModelForTokenClassification
 
-ner_pipeline = load_ner_pipeline()
+        ort_model = ORTModelForTokenClassification.from_pretrained(NER_ONNX_MODEL_DIR)
+        tokenizer = AutoTokenizer.from_pretrained(NER_ONNX_MODEL_DIR)
+        return pipeline("ner", model=ort_model, tokenizer=tokenizer, aggregation_strategy="first", stride=TOKEN_STRIDE)
+    ner_pipe = pipeline(
+        "ner",
+        model="d4data/biomedical-ner-all",
+        aggregation_strategy="first",
+        stride=TOKEN_STRIDE,
+        torch_dtype=NER_TORCH_DTYPE,
+        device_map="auto",
+        model_kwargs={"attn_implementation": "sdpa"},
+    )
+    if NER_TORCH_COMPILE:
+        eager_model = ner_pipe.model
+        try:
+            ner_pipe.model = torch.compile(eager_model, dynamic=True)
+            # Warm up with a single input and a batch; size-1 dimensions are specialized even with dynamic=True
+            with torch.inference_mode():
+                ner_pipe(NER_WARMUP_TEXT)
+                ner_pipe([NER_WARMUP_TEXT] * 2, batch_size=NER_BATCH_SIZE)
+        except Exception:
+            # Compilation needs a working toolchain (a C++ compiler for Inductor on CPU); serve the eager model instead
+            ner_pipe.model = eager_model
+    return ner_pipe
+
+# Set NER_BACKEND=gliner to use the GLiNER-BioMed bi-encoder instead of the token-classification pipeline
+NER_BACKEND = os.getenv("NER_BACKEND", "pipeline")
+GLINER_MODEL_NAME = "Ihor/gliner-biomed-bi-large-v1.0"
+GLINER_LABELS = ["disease", "disorder", "drug", "sign or symptom", "diagnostic procedure", "lab value", "anatomy"]
+GLINER_THRESHOLD = 0.5
+GLINER_MAX_WORDS = 384
+# GLiNER's own word splitter, under which every punctuation mark counts as a word towards GLINER_MAX_WORDS
+GLINER_WORD_RE = re.compile(r"\w+(?:[-_]\w+)*|\S")
+
+# Load the GLiNER-BioMed model and encode its labels once, since the bi-encoder keeps them independent of the text
+@st.cache_resource
+def load_gliner_model():
+    # Imported here because gliner is only needed when NER_BACKEND=gliner
+    from gliner import GLiNER
+
+    model = GLiNER.from_pretrained(GLINER_MODEL_NAME)
+    label_embeddings = model.encode_labels(GLINER_LABELS, batch_size=len(GLINER_LABELS))
+    return model, label_embeddings
+
+if NER_BACKEND == "gliner":
+    gliner_model, gliner_label_embeddings = load_gliner_model()
+else:
+    ner_pipeline = load_ner_pipeline()
+
+# Function to run GLiNER over a batch of texts, returning entities shaped like pipeline output
+def predict_gliner_entities(texts):
+    outputs = gliner_model.batch_predict_with_embeds(texts, gliner_label_embeddings, GLINER_LABELS, threshold=GLINER_THRESHOLD)
+    return [
+        [
+            {"word": entity["text"], "entity_group": entity["label"], "score": entity["score"], "start": entity["start"], "end": entity["end"]}
+            for entity in entities
+        ]
+        for entities in outputs
+    ]
+
+# Long texts are split into sentence-aligned chunks that fit the model and run through it in batches
+MAX_CHUNK_CHARS = 1000
+MAX_CHUNK_TOKENS = MAX_SEQ_LENGTH - 2
+SENTENCE_RE = re.compile(r"[^.!?\n]{1,%d}[.!?]*" % MAX_CHUNK_CHARS)
+
+# Function to count model tokens (or GLiNER words) in each sentence with one fast-tokenizer call
+def count_chunk_tokens(sentences):
+    if NER_BACKEND == "gliner":
+        return [len(GLINER_WORD_RE.findall(sentence)) for sentence in sentences]
+    return [len(ids) for ids in ner_pipeline.tokenizer(sentences, add_special_tokens=False)["input_ids"]]
+
+# Function to split text into chunks of whole sentences, returned with their offsets
+def split_into_chunks(text):
+    matches = list(SENTENCE_RE.finditer(text))
+    if not matches:
+        return []
+    max_tokens = GLINER_MAX_WORDS if NER_BACKEND == "gliner" else MAX_CHUNK_TOKENS
+    token_counts = count_chunk_tokens([match.group() for match in matches])
+
+    chunks = []
+    chunk_start = chunk_end = None
+    chunk_tokens = 0
+    for match, token_count in zip(matches, token_counts):
+        start, end = match.span()
+        if chunk_start is not None and chunk_tokens + token_count > max_tokens:
+            chunks.append((chunk_start, text[chunk_start:chunk_end]))
+            chunk_start = None
+        if chunk_start is None:
+            chunk_start = start
+            chunk_tokens = 0
+        chunk_end = end
+        chunk_tokens += token_count
+    if chunk_start is not None:
+        chunks.append((chunk_start, text[chunk_start:chunk_end]))
+    return [(offset, chunk) for offset, chunk in chunks if chunk.strip()]
+
+# Function to run batched NER over a text and map entity spans back onto it
+@st.cache_data(show_spinner="Running NER...", max_entries=64)
+def run_ner(text):
+    chunks = split_into_chunks(text)
+    if not chunks:
+        return []
+    texts = [chunk for _, chunk in chunks]
+    with torch.inference_mode():
+        if NER_BACKEND == "gliner":
+            outputs = predict_gliner_entities(texts)
+        else:
+            outputs = ner_pipeline(texts, batch_size=NER_BATCH_SIZE)
+    results = []
+    for (offset, _), entities in zip(chunks, outputs):
+        for entity in entities:
+            entity = dict(entity)
+            if entity.get("start") is not None:
+                entity["start"] += offset
+                entity["end"] += offset
+            results.append(entity)
+    return results
+
+# Function to split a B-/I- tagged label into its prefix and entity type, as the pipeline does
+def split_entity_label(label):
+    if label.startswith(("B-", "I-")):
+        return label[0], label[2:]
+    return "I", label
+
+# Function to run NER on a long document from a single fast-tokenizer pass, mirroring aggregation_strategy="first"
+@st.cache_data(show_spinner="Running NER...", max_entries=64)
+def run_ner_document(text):
+    if NER_BACKEND == "gliner":
+        return run_ner(text)
+    tokenizer = ner_pipeline.tokenizer
+    model = ner_pipeline.model
+    encoding = tokenizer(
+        text,
+        max_length=MAX_SEQ_LENGTH,
+        stride=TOKEN_STRIDE,
+        truncation=True,
+        padding=True,
+        return_overflowing_tokens=True,
+        return_offsets_mapping=True,
+        return_tensors="pt",
+    )
+    offset_mapping = encoding.pop("offset_mapping").tolist()
+    encoding.pop("overflow_to_sample_mapping", None)
+    id2label = model.config.id2label
+
+    # Each word takes its label and score from its first sub-token; later sub-tokens extend its span and tokens,
+    # skipping tokens repeated in the overlap between windows
+    words = {}
+    with torch.inference_mode():
+        for batch_start in range(0, len(offset_mapping), NER_BATCH_SIZE):
+            batch = {key: value[batch_start:batch_start + NER_BATCH_SIZE].to(model.device) for key, value in encoding.items()}
+            scores, label_ids = model(**batch).logits.float().softmax(dim=-1).max(dim=-1)
+            scores, label_ids = scores.tolist(), label_ids.tolist()
+            for row in range(len(label_ids)):
+                window = batch_start + row
+                tokens = encoding.tokens(window)
+                for token, word_id in enumerate(encoding.word_ids(window)):
+                    if word_id is None:
+                        continue
+                    start, end = offset_mapping[window][token]
+                    if word_id not in words:
+                        words[word_id] = [start, end, id2label[label_ids[row][token]], scores[row][token], [tokens[token]]]
+                    elif end > words[word_id][1]:
+                        words[word_id][1] = end
+                        words[word_id][4].append(tokens[token])
+
+    groups = []
+    for start, end, label, score, word_tokens in (words[word_id] for word_id in sorted(words)):
+        bi, entity_type = split_entity_label(label)
+        if groups and entity_type == groups[-1]["entity_group"] and bi != "B":
+            groups[-1]["end"] = end
+            groups[-1]["scores"].append(score)
+            groups[-1]["tokens"].extend(word_tokens)
+        else:
+            groups.append({"entity_group": entity_type, "start": start, "end": end, "scores": [score], "tokens": list(word_tokens)})
+
+    return [
+        {
+            "entity_group": group["entity_group"],
+            "score": sum(group["scores"]) / len(group["scores"]),
+            # Decoded like the pipeline does, so EXCLUDED_TERMS and DISEASE_OVERRIDES match the same forms
+            "word": tokenizer.convert_tokens_to_string(group["tokens"]),
+            "start": group["start"],
+            "end": group["end"],
+        }
+        for group in groups
+        if group["entity_group"] != "O"
+    ]
 
 # Function to load disease names from a file
 def load_disease_list(file_path="diseases.txt"):
@@ -32,48 +323,295 @@ def load_disease_list(file_path="diseases.txt"):
 
 DISEASE_OVERRIDES = load_disease_list()
 
-# Function to merge WordPiece tokens into full words
-def detokenize_wordpieces(tokens):
-    merged_tokens = []
-    current_word = ""
-    
-    for token in tokens:
-        if token.startswith("##"):
-            current_word += token[2:]
-        else:
-            if current_word:
-                merged_tokens.append(current_word)
-            current_word = token
-    
-    if current_word:
-        merged_tokens.append(current_word)
-    
-    return merged_tokens
+# Process-wide cache of drug recommendations, shared by every session, with a lock for writers
+@st.cache_resource
+def load_recommendation_cache():
+    return {}, threading.Lock()
 
-# Function to get drug recommendations from Google Gemini
-def get_drug_recommendation(disease):
+recommendation_cache, recommendation_cache_lock = load_recommendation_cache()
+
+# WordPiece decoding spaces out apostrophes ("parkinson ' s disease")
+APOSTROPHE_RE = re.compile(r"\s*'\s*")
+
+# Function to normalize a disease name so equivalent spellings share a cache entry
+def normalize_disease(disease):
+    return " ".join(APOSTROPHE_RE.sub("'", disease.replace("-", " ").lower()).split())
+
+# Function to load curated first-line drugs for common diseases
+def load_formulary(file_path="formulary.json"):
+    try:
+        with open(file_path, "r") as f:
+            return {normalize_disease(disease): drugs for disease, drugs in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+FORMULARY = load_formulary()
+
+def recommendation_cache_key(disease):
+    return f"drug:{hashlib.sha256(normalize_disease(disease).encode('utf-8')).hexdigest()}"
+
+# Function to look up diseases covered by the formulary or a fresh cached recommendation
+def get_cached_recommendations(diseases):
+    now = time.time()
+    cached = {}
+    for disease in diseases:
+        drugs = FORMULARY.get(normalize_disease(disease))
+        if drugs:
+            cached[disease] = drugs
+            continue
+        entry = recommendation_cache.get(recommendation_cache_key(disease))
+        if entry:
+            cached_at, drugs = entry
+            ttl = NO_RECOMMENDATIONS_TTL_SECONDS if drugs == NO_RECOMMENDATIONS else RECOMMENDATION_TTL_SECONDS
+            if now - cached_at < ttl:
+                cached[disease] = drugs
+    return cached
+
+# Function to store fresh recommendations, evicting expired entries and then the oldest ones
+def cache_recommendations(recommendations):
+    now = time.time()
+    with recommendation_cache_lock:
+        for disease, drugs in recommendations.items():
+            key = recommendation_cache_key(disease)
+            # Re-insert so the dict stays ordered from oldest to newest write
+            recommendation_cache.pop(key, None)
+            recommendation_cache[key] = (now, drugs)
+        # Entries past the longest TTL are expired whatever they hold; shorter-lived negative
+        # entries are skipped on read and age out here or through the size cap
+        for key, (cached_at, _) in list(recommendation_cache.items()):
+            if now - cached_at < RECOMMENDATION_TTL_SECONDS:
+                break
+            del recommendation_cache[key]
+        while len(recommendation_cache) > RECOMMENDATION_CACHE_MAX_ENTRIES:
+            del recommendation_cache[next(iter(recommendation_cache))]
+
+# Function to ask Gemini for a single disease's drugs, bypassing the cache
+def fetch_drug_recommendation(disease):
     cleaned_disease = disease.replace("-", " ").capitalize()
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    response = model.generate_content(
-        f"List only the drug names used to treat {cleaned_disease}, separated by commas. No explanations, just drug names."
+    response = GEMINI_MODEL.generate_content(SINGLE_PROMPT_TEMPLATE.format(cleaned_disease))
+    return response.text.strip() if response.text else NO_RECOMMENDATIONS
+
+# Function to get drug recommendations for several diseases in a single Gemini call
+def get_drug_recommendations_bulk(diseases):
+    diseases = sorted(diseases)
+    recommendations = get_cached_recommendations(diseases)
+    missing = [disease for disease in diseases if disease not in recommendations]
+    if not missing:
+        return {disease: recommendations[disease] for disease in diseases}
+    cleaned_diseases = "\n".join(f"- {disease.replace('-', ' ').capitalize()}" for disease in missing)
+    response = GEMINI_MODEL.generate_content(
+        BULK_PROMPT_PREFIX + cleaned_diseases,
+        generation_config={"response_mime_type": "application/json"},
     )
-    return response.text.strip() if response.text else "No recommendations found"
+    try:
+        parsed = json.loads(response.text) if response.text else {}
+    except json.JSONDecodeError:
+        parsed = {}
+    if not isinstance(parsed, dict):
+        parsed = {}
+    drugs_by_disease = {normalize_disease(key): value for key, value in parsed.items()}
+
+    fetched = {}
+    for disease in missing:
+        drugs = drugs_by_disease.get(normalize_disease(disease))
+        if isinstance(drugs, list):
+            drugs = ", ".join(str(drug).strip() for drug in drugs if str(drug).strip())
+        fetched[disease] = drugs.strip() if isinstance(drugs, str) and drugs.strip() else NO_RECOMMENDATIONS
+
+    # Diseases the bulk answer left out are asked for one by one, concurrently
+    unanswered = [disease for disease in missing if fetched[disease] == NO_RECOMMENDATIONS]
+    if unanswered:
+        with ThreadPoolExecutor(max_workers=min(8, len(unanswered))) as executor:
+            fetched.update(zip(unanswered, executor.map(fetch_drug_recommendation, unanswered)))
+
+    cache_recommendations(fetched)
+    recommendations.update(fetched)
+    return {disease: recommendations[disease] for disease in diseases}
+
+# Function to get drug recommendations from Google Gemini
+def get_drug_recommendation(disease):
+    return get_drug_recommendations_bulk([disease])[disease]
+
+# Function to delete an uploaded batch request file, ignoring files that are already gone
+def delete_batch_file(file_name):
+    try:
+        batch_client.files.delete(name=file_name)
+    except (genai_errors.APIError, httpx.HTTPError):
+        pass
+
+# Function to check a submitted batch job once, caching its recommendations when it has finished
+# Returns True once the job is finished, failed or cancelled and its request file cleaned up
+def poll_drug_recommendations_batch(batch):
+    try:
+        batch_job = batch_client.batches.get(name=batch["job"])
+    except (genai_errors.APIError, httpx.HTTPError):
+        return False
+    state = batch_job.state.name
+    if state not in BATCH_DONE_STATES:
+        if time.time() - batch["submitted"] <= BATCH_TIMEOUT_SECONDS:
+            return False
+        try:
+            batch_client.batches.cancel(name=batch["job"])
+        except (genai_errors.APIError, httpx.HTTPError):
+            pass
+        delete_batch_file(batch["file"])
+        return True
 
-# Function to extract text from uploaded files
+    delete_batch_file(batch["file"])
+    if state != "JOB_STATE_SUCCEEDED" or not batch_job.dest or not batch_job.dest.file_name:
+        return True
+    try:
+        results = batch_client.files.download(file=batch_job.dest.file_name).decode("utf-8")
+    except (genai_errors.APIError, httpx.HTTPError):
+        return True
+
+    fetched = {disease: NO_RECOMMENDATIONS for disease in batch["diseases"]}
+    for line in results.splitlines():
+        try:
+            result = json.loads(line)
+            text = result["response"]["candidates"][0]["content"]["parts"][0]["text"].strip()
+        except (json.JSONDecodeError, KeyError, IndexError, TypeError, AttributeError):
+            continue
+        if result.get("key") in fetched and text:
+            fetched[result["key"]] = text
+    cache_recommendations(fetched)
+    return True
+
+# Function run by the background thread: polls every live batch job, so results are cached and
+# timed-out jobs cancelled even when no session comes back for them
+def watch_batch_jobs(registry):
+    while True:
+        time.sleep(BATCH_POLL_INTERVAL_SECONDS)
+        with registry["lock"]:
+            batches = list(registry["jobs"].values())
+        for batch in batches:
+            if poll_drug_recommendations_batch(batch):
+                with registry["lock"]:
+                    registry["jobs"].pop(batch["job"], None)
+
+# Process-wide registry of live batch jobs, with the thread that watches them
+@st.cache_resource
+def load_batch_registry():
+    registry = {"jobs": {}, "lock": threading.Lock()}
+    threading.Thread(target=watch_batch_jobs, args=(registry,), daemon=True).start()
+    return registry
+
+batch_registry = load_batch_registry()
+
+# Function to list diseases that a live batch job will answer
+def get_pending_batch_diseases():
+    with batch_registry["lock"]:
+        return {disease for batch in batch_registry["jobs"].values() for disease in batch["diseases"]}
+
+# Function to submit a Gemini Batch API job (discounted, non-interactive), returning False if it could not be submitted
+def submit_drug_recommendations_batch(diseases):
+    lines = []
+    for disease in diseases:
+        cleaned_disease = disease.replace("-", " ").capitalize()
+        prompt = SINGLE_PROMPT_TEMPLATE.format(cleaned_disease)
+        lines.append(json.dumps({"key": disease, "request": {"contents": [{"parts": [{"text": prompt}]}]}}))
+
+    try:
+        requests_file = batch_client.files.upload(
+            file=io.BytesIO("\n".join(lines).encode("utf-8")),
+            config={"display_name": "drug-recommendations", "mime_type": "jsonl"},
+        )
+    except (genai_errors.APIError, httpx.HTTPError):
+        return False
+    try:
+        batch_job = batch_client.batches.create(
+            model=GEMINI_MODEL_NAME,
+            src=requests_file.name,
+            config={"display_name": "drug-recommendations"},
+        )
+    except (genai_errors.APIError, httpx.HTTPError):
+        delete_batch_file(requests_file.name)
+        return False
+
+    with batch_registry["lock"]:
+        batch_registry["jobs"][batch_job.name] = {
+            "job": batch_job.name,
+            "file": requests_file.name,
+            "diseases": list(diseases),
+            "submitted": time.time(),
+        }
+    return True
+
+# Function to extract text from uploaded files, returning it with a hash of the file contents
 def extract_text_from_file(uploaded_file):
-    if uploaded_file.type == "text/plain":
-        return uploaded_file.read().decode("utf-8")
-    elif uploaded_file.type == "application/pdf":
-        pdf_reader = PyPDF2.PdfReader(uploaded_file)
-        return "\n".join([page.extract_text() for page in pdf_reader.pages if page.extract_text()])
-    elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-        doc = Document(uploaded_file)
-        return "\n".join([para.text for para in doc.paragraphs])
+    raw = uploaded_file.getvalue()
+    file_hash = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    return extract_text_from_bytes(file_hash, uploaded_file.type, raw), file_hash
+
+# Cached on the content hash; the leading underscore keeps Streamlit from hashing the raw bytes again
+@st.cache_data(show_spinner="Extracting text...", max_entries=64)
+def extract_text_from_bytes(file_hash, file_type, _raw):
+    if file_type == "text/plain":
+        return _raw.decode("utf-8")
+    elif file_type == "application/pdf":
+        with pymupdf.open(stream=_raw, filetype="pdf") as pdf_doc:
+            page_texts = (page.get_text() for page in pdf_doc)
+            return "\n".join(page_text for page_text in page_texts if page_text.strip())
+    elif file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+        doc = Document(io.BytesIO(_raw))
+        return "\n".join(para.text for para in doc.paragraphs)
     return ""
 
 # List of non-disease terms to exclude
 EXCLUDED_TERMS = {"ecg", "troponin", "examination", "sars - cov - 2"}
 
+# Entity labels that count as diseases
+DISEASE_RE = re.compile(r"disease|disorder", re.IGNORECASE)
+
+# Function to run NER on a text and collect its entities and recognized diseases
+def run_ner_analysis(text, ner=run_ner):
+    results = ner(text)
+    if not results:
+        return [], set()
+
+    df = pd.DataFrame(results)
+    df["word"] = df["word"].str.replace("##", "", regex=False)
+    df["word_lower"] = df["word"].str.lower()
+    entity_type = df.get("entity", df.get("entity_group"))
+    df["entity_type"] = "Unknown" if entity_type is None else entity_type.fillna("Unknown")
+
+    df.loc[df["word_lower"].isin(DISEASE_OVERRIDES), "entity_type"] = "Disease_disorder"
+
+    disease_mask = df["entity_type"].str.contains(DISEASE_RE) & ~df["word_lower"].isin(EXCLUDED_TERMS)
+    recognized_diseases = set(df.loc[disease_mask, "word_lower"])
+    entities = df[["word", "entity_type"]].rename(columns={"word": "Word", "entity_type": "Entity"}).to_dict("records")
+
+    return entities, recognized_diseases
+
+# Function to get drug recommendations for an uploaded file
+# Formulary and cached answers are shown straight away; the remaining diseases go to one discounted
+# batch job instead of a synchronous call, and show as pending until the job has filled the cache
+def get_file_drug_recommendations(diseases):
+    diseases = sorted(diseases)
+    recommendations = get_cached_recommendations(diseases)
+    pending = get_pending_batch_diseases()
+    missing = [disease for disease in diseases if disease not in recommendations and disease not in pending]
+    if missing and not submit_drug_recommendations_batch(missing):
+        # The batch job could not be submitted, so answer synchronously instead
+        recommendations.update(get_drug_recommendations_bulk(missing))
+    if any(disease not in recommendations for disease in diseases):
+        st.caption("Pending recommendations come from a discounted Gemini batch job; click **Analyze File** again later to load them.")
+    return {disease: recommendations.get(disease, BATCH_PENDING) for disease in diseases}
+
+# Function to display detected entities and drug recommendations
+def render_results(entities, recognized_diseases, get_recommendations=get_drug_recommendations_bulk):
+    if entities:
+        st.subheader("🔎 Named Entities Detected:")
+        st.table(entities)
+    else:
+        st.info("No biomedical entities detected.")
+
+    if recognized_diseases:
+        st.subheader("💊 Recommended Drugs:")
+        recommendations = get_recommendations(recognized_diseases)
+        for disease, drugs in recommendations.items():
+            st.markdown(f"**{disease.title()}**: {drugs}")
+
 # Streamlit UI
 st.title("Biomedical NER App")
 st.markdown("**Powered by BioBERT**")
@@ -101,67 +639,17 @@ with tab1:
     text = st.text_area("Enter text for NER analysis:")
     if st.button("Analyze Text"):
         if text.strip():
-            results = ner_pipeline(text)
-            recognized_diseases = set()
-            entities = []
-
-            for entity in results:
-                word = detokenize_wordpieces([entity["word"].replace("##", "")])[0]
-                entity_type = entity.get("entity", entity.get("entity_group", "Unknown"))
-
-                if word.lower() in DISEASE_OVERRIDES:
-                    entity_type = "Disease_disorder"
-
-                if any(keyword in entity_type.lower() for keyword in ["disease", "disorder"]) and word.lower() not in EXCLUDED_TERMS:
-                    recognized_diseases.add(word.lower())
-                
-                entities.append({"Word": word, "Entity": entity_type})
-
-            if entities:
-                st.subheader("🔎 Named Entities Detected:")
-                st.table(entities)
-            else:
-                st.info("No biomedical entities detected.")
-
-            if recognized_diseases:
-                st.subheader("💊 Recommended Drugs:")
-                for disease in recognized_diseases:
-                    drugs = get_drug_recommendation(disease)
-                    st.markdown(f"**{disease.title()}**: {drugs}")
+            entities, recognized_diseases = run_ner_analysis(text)
+            render_results(entities, recognized_diseases)
         else:
             st.warning("Please enter text for analysis.")
 
 with tab2:
     uploaded_file = st.file_uploader("Upload a text, PDF, or Word file", type=["txt", "pdf", "docx"])
     if uploaded_file and st.button("Analyze File"):
-        text = extract_text_from_file(uploaded_file)
+        text, _ = extract_text_from_file(uploaded_file)
         if text.strip():
-            results = ner_pipeline(text)
-            recognized_diseases = set()
-            entities = []
-
-            for entity in results:
-                word = detokenize_wordpieces([entity["word"].replace("##", "")])[0]
-                entity_type = entity.get("entity", entity.get("entity_group", "Unknown"))
-
-                if word.lower() in DISEASE_OVERRIDES:
-                    entity_type = "Disease_disorder"
-
-                if any(keyword in entity_type.lower() for keyword in ["disease", "disorder"]) and word.lower() not in EXCLUDED_TERMS:
-                    recognized_diseases.add(word.lower())
-                
-                entities.append({"Word": word, "Entity": entity_type})
-
-            if entities:
-                st.subheader("🔎 Named Entities Detected:")
-                st.table(entities)
-            else:
-                st.info("No biomedical entities detected.")
-
-            if recognized_diseases:
-                st.subheader("💊 Recommended Drugs:")
-                for disease in recognized_diseases:
-                    drugs = get_drug_recommendation(disease)
-                    st.markdown(f"**{disease.title()}**: {drugs}")
+            entities, recognized_diseases = run_ner_analysis(text, run_ner_document)
+            render_results(entities, recognized_diseases, get_file_drug_recommendations)
         else:
             st.warning("No text extracted from file.")